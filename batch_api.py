@@ -0,0 +1,359 @@
+"""
+Local HTTP batch API over the same pipeline as the Streamlit page.
+
+    python batch_api.py --port 8502
+
+POST /procesar       PDFs (application/pdf), a zip (application/zip) or multipart/form-data with
+                     any mix of .pdf, .zip and one .xlsx. Answers with newline-delimited JSON: one
+                     line per invoice as soon as it finishes, then a final "fin" line with the metrics.
+GET  /lotes/<id>/excel     Updated workbook of that run (only when an .xlsx was sent).
+GET  /lotes/<id>/metricas  Metrics of that run as JSON.
+
+Everything slow happens once at startup: the server process loads openpyxl (it builds the workbooks)
+and the worker pool loads pdfplumber, rapidfuzz, the municipality matcher and the vocabulary indices,
+and all of it stays loaded between requests.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pipeline
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+MAX_BODY_BYTES = 200 * 1024 * 1024
+# MAX_BODY_BYTES only caps the compressed body; these cap what zips may expand into
+MAX_UNZIPPED_BYTES = 500 * 1024 * 1024
+MAX_ZIP_DEPTH = 2
+MAX_STORED_RUNS = 32
+
+# --- WORKERS ---
+def _warm_worker():
+    # Load the heavy modules and run one fuzzy lookup (a word outside the vocabulary, so it
+    # isn't answered by the exact VOCAB_INDEX hit) so the first real invoice doesn't pay for them
+    pipeline.load_dependencies()
+    pipeline.fuzzy_match_category("tomatillo")
+
+def _run_invoice(index, file_name, data):
+    t0 = time.perf_counter()
+    try:
+        record = pipeline.process_invoice(data, file_name)
+    except Exception as e:
+        record = {'archivo': file_name, 'municipio_id': None, 'error': str(e)}
+    return index, record, (time.perf_counter() - t0) * 1000
+
+# --- REQUEST PARSING ---
+def _unzip(data, pdfs, excel, depth, budget):
+    if depth >= MAX_ZIP_DEPTH:
+        raise ValueError("Demasiados zips anidados.")
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            for info in zf.infolist():
+                if info.is_dir() or os.path.basename(info.filename).startswith('.'): continue
+                # file_size comes from the zip header; ZipExtFile never inflates past it
+                budget['bytes'] -= info.file_size
+                if budget['bytes'] < 0:
+                    raise ValueError("El zip descomprimido es demasiado grande.")
+                _collect(os.path.basename(info.filename), zf.read(info), pdfs, excel, depth + 1, budget)
+    except (zipfile.BadZipFile, RuntimeError, NotImplementedError, EOFError, OSError) as e:
+        raise ValueError(f"Zip inválido: {e}")
+
+def _collect(file_name, data, pdfs, excel, depth=0, budget=None):
+    """Sorts one uploaded file into the PDF list, the workbook slot, or unpacks it if it's a zip."""
+    if budget is None: budget = {'bytes': MAX_UNZIPPED_BYTES}
+    lower = (file_name or "").lower()
+    if lower.endswith('.zip') or (not lower.endswith('.xlsx') and zipfile.is_zipfile(io.BytesIO(data))):
+        _unzip(data, pdfs, excel, depth, budget)
+    elif lower.endswith('.xlsx'):
+        excel.append(data)
+    elif lower.endswith('.pdf') or data[:5] == b'%PDF-':
+        pdfs.append((file_name or f"factura_{len(pdfs) + 1}.pdf", data))
+
+def parse_upload(content_type, body, file_name=None):
+    """Returns (pdfs, xlsx_bytes_or_None) from a request body. Raises ValueError on bad input."""
+    pdfs, excel = [], []
+    budget = {'bytes': MAX_UNZIPPED_BYTES}
+    ctype = (content_type or "").split(';')[0].strip().lower()
+
+    if ctype == 'multipart/form-data':
+        msg = BytesParser(policy=policy.HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+        if not msg.is_multipart():
+            raise ValueError("Cuerpo multipart inválido.")
+        for part in msg.iter_parts():
+            data = part.get_payload(decode=True) or b""
+            _collect(part.get_filename() or part.get_param('name', header='content-disposition'), data, pdfs, excel, budget=budget)
+    elif ctype == 'application/zip':
+        _collect(file_name or "facturas.zip", body, pdfs, excel, budget=budget)
+    elif ctype == 'application/pdf':
+        _collect(file_name or "factura.pdf", body, pdfs, excel, budget=budget)
+    else:
+        raise ValueError("Use application/pdf, application/zip o multipart/form-data.")
+
+    if not pdfs:
+        raise ValueError("No se encontraron facturas PDF en la solicitud.")
+    if len(excel) > 1:
+        raise ValueError("Envíe un solo archivo de Excel.")
+    return pdfs, (excel[0] if excel else None)
+
+# --- RUNS ---
+def build_metrics(run_id, records, timings, elapsed):
+    totals = {}
+    for record in records:
+        if not record.get('municipio_id'): continue
+        t = totals.setdefault(record['municipio'], {'abarrotes': 0.0, 'agricultura': 0.0, 'emisores': set(), 'receptores': set()})
+        t['abarrotes'] += record['abarrotes']
+        t['agricultura'] += record['agricultura']
+        if record['nit_emisor'] != "N/A": t['emisores'].add(record['nit_emisor'])
+        if record['nit_receptor'] != "N/A": t['receptores'].add(record['nit_receptor'])
+
+    return {
+        'lote': run_id,
+        'facturas': len(records),
+        'procesadas': sum(1 for r in records if r.get('municipio_id')),
+        'sin_municipio': sum(1 for r in records if not r.get('municipio_id') and 'error' not in r),
+        'errores': sum(1 for r in records if 'error' in r),
+        'items_sin_clasificar': sum(len(r.get('sin_clasificar', [])) for r in records),
+        'segundos': round(elapsed, 3),
+        'ms_promedio': round(sum(timings) / len(timings), 1) if timings else 0.0,
+        'ms_max': round(max(timings), 1) if timings else 0.0,
+        'totales': {name: {'abarrotes': t['abarrotes'], 'agricultura': t['agricultura'],
+                           'emisores': len(t['emisores']), 'receptores': len(t['receptores'])}
+                    for name, t in totals.items()},
+    }
+
+class BatchServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, workers=None):
+        super().__init__(address, BatchHandler)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool_lock = threading.Lock()
+        self.executor = None
+        try:
+            # open_report/finish_report run here, not in the workers, so this process needs openpyxl warm too
+            pipeline.load_dependencies()
+            try:
+                self.executor = self._start_pool()
+            except BrokenProcessPool:
+                # One retry: a worker can die for reasons unrelated to the pool (OOM killer)
+                self.executor = self._start_pool()
+        except BaseException:
+            # The socket is already bound; don't leak it
+            super().server_close()
+            raise
+        self.runs = OrderedDict()
+        self.runs_lock = threading.Lock()
+
+    def _start_pool(self):
+        # spawn instead of fork: the server is already multi-threaded when workers start
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        # Start every worker now instead of on the first request, and fail loudly if any can't start
+        try:
+            for future in [executor.submit(_warm_worker) for _ in range(self.workers)]:
+                future.result()
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        return executor
+
+    def reset_pool(self, broken):
+        """Replaces the pool if it's still the broken one; a crashed worker breaks the whole ProcessPoolExecutor."""
+        with self.pool_lock:
+            if self.executor is broken:
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = self._start_pool()
+            return self.executor
+
+    def submit_batch(self, pdfs):
+        """Submits every invoice; rebuilds the pool once if it turns out to be broken. Returns (executor, {future: (index, name)})."""
+        executor = self.executor
+        for attempt in range(2):
+            try:
+                return executor, {executor.submit(_run_invoice, i, name, data): (i, name) for i, (name, data) in enumerate(pdfs)}
+            except BrokenProcessPool:
+                if attempt: raise
+                executor = self.reset_pool(executor)
+            except RuntimeError:
+                # Another request's reset_pool shut this pool down after we read it; use its replacement
+                with self.pool_lock:
+                    current = self.executor
+                if attempt or current is executor: raise
+                executor = current
+
+    def store_run(self, run_id, run):
+        with self.runs_lock:
+            self.runs[run_id] = run
+            while len(self.runs) > MAX_STORED_RUNS:
+                self.runs.popitem(last=False)
+
+    def get_run(self, run_id):
+        with self.runs_lock:
+            return self.runs.get(run_id)
+
+    def server_close(self):
+        super().server_close()
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+# --- HTTP ---
+class BatchHandler(BaseHTTPRequestHandler):
+    server_version = "MagaFacturas/1.0"
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_line(self, payload):
+        self.wfile.write(json.dumps(payload, ensure_ascii=False).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def do_GET(self):
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'lotes' or parts[2] not in ('excel', 'metricas'):
+            return self._send_json(404, {'error': "Ruta no encontrada."})
+
+        run = self.server.get_run(parts[1])
+        if run is None:
+            return self._send_json(404, {'error': "Lote no encontrado."})
+
+        if parts[2] == 'metricas':
+            return self._send_json(200, run['metricas'])
+
+        if run.get('error_excel'):
+            return self._send_json(500, {'error': run['error_excel']})
+        if run['excel'] is None:
+            return self._send_json(404, {'error': "Este lote se procesó sin archivo de Excel."})
+        self.send_response(200)
+        self.send_header('Content-Type', XLSX_MIME)
+        self.send_header('Content-Disposition', 'attachment; filename="Reporte_MAGA_Actualizado.xlsx"')
+        self.send_header('Content-Length', str(len(run['excel'])))
+        self.end_headers()
+        self.wfile.write(run['excel'])
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/procesar':
+            return self._send_json(404, {'error': "Ruta no encontrada."})
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            return self._send_json(400, {'error': "Content-Length inválido."})
+        if length <= 0:
+            return self._send_json(411, {'error': "Falta Content-Length."})
+        if length > MAX_BODY_BYTES:
+            return self._send_json(413, {'error': "La solicitud es demasiado grande."})
+        body = self.rfile.read(length)
+
+        try:
+            pdfs, xlsx = parse_upload(self.headers.get('Content-Type'), body, self.headers.get('X-Filename'))
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+
+        report = None
+        if xlsx is not None:
+            try:
+                report = pipeline.open_report(xlsx)
+            except ValueError as e:
+                return self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                # Not a workbook at all (KeyError on a plain zip, InvalidFileException, ...)
+                return self._send_json(400, {'error': f"No se pudo leer el archivo de Excel: {e}"})
+
+        run_id = uuid.uuid4().hex[:12]
+        t0 = time.perf_counter()
+        try:
+            executor, futures = self.server.submit_batch(pdfs)
+        except Exception as e:
+            return self._send_json(503, {'error': f"Los procesos de extracción no están disponibles: {e}"})
+
+        # Close-delimited stream: no Content-Length, one JSON object per line
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('X-Lote', run_id)
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+
+        records, timings = [None] * len(pdfs), [0.0] * len(pdfs)
+        client_alive, pool_broken = True, False
+        for future in as_completed(futures):
+            try:
+                index, record, ms = future.result()
+            except Exception as e:
+                pool_broken = pool_broken or isinstance(e, BrokenProcessPool)
+                index, name = futures[future]
+                record, ms = {'archivo': name, 'municipio_id': None, 'error': str(e)}, 0.0
+            records[index], timings[index] = record, ms
+            if client_alive:
+                try:
+                    self._write_line({'tipo': 'factura', 'indice': index, 'ms': round(ms, 1), **record})
+                except (BrokenPipeError, ConnectionResetError):
+                    # Keep going so the run is still stored for the other endpoints
+                    client_alive = False
+
+        # Rebuild now so the next request doesn't have to
+        if pool_broken:
+            try:
+                self.server.reset_pool(executor)
+            except Exception:
+                pass  # submit_batch retries on the next request
+
+        # Apply in upload order so the workbook doesn't depend on which worker finished first
+        excel, error_excel = None, None
+        if report is not None:
+            try:
+                for record in records:
+                    if 'error' not in record:
+                        pipeline.add_invoice(report, record)
+                excel = pipeline.finish_report(report)
+            except Exception as e:
+                error_excel = f"No se pudo generar el Excel: {e}"
+                if client_alive:
+                    try:
+                        self._write_line({'tipo': 'error', 'error': error_excel})
+                    except (BrokenPipeError, ConnectionResetError):
+                        client_alive = False
+
+        metrics = build_metrics(run_id, records, timings, time.perf_counter() - t0)
+        self.server.store_run(run_id, {'metricas': metrics, 'excel': excel, 'error_excel': error_excel})
+
+        if client_alive:
+            try:
+                self._write_line({'tipo': 'fin', **metrics})
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+def main():
+    parser = argparse.ArgumentParser(description="API local por lotes para el procesador de facturas.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8502)
+    parser.add_argument('--workers', type=int, default=None, help="Procesos de extracción (por defecto, uno por CPU).")
+    args = parser.parse_args()
+
+    server = BatchServer((args.host, args.port), workers=args.workers)
+    print(f"Escuchando en http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Startup benchmark for the Streamlit apps (Totonicapan.py and totobase.py).
+
+    python bench_startup.py                     # print the numbers
+    python bench_startup.py --max-import-ms 150 --max-render-ms 1500 --max-rerun-ms 300
+
+Every sample runs in a fresh interpreter so the numbers are cold-start numbers:
+  import_ms        time to `import pipeline`
+  first_render_ms  first run of each app through Streamlit's AppTest (no button pressed)
+  rerun_ms         a second run in the same process, i.e. the cost of a widget interaction
+It also fails if pdfplumber, openpyxl or rapidfuzz get loaded before anything is processed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ('pdfplumber', 'openpyxl', 'rapidfuzz')
+APPS = ('Totonicapan.py', 'totobase.py')
+
+IMPORT_PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import pipeline
+ms = (time.perf_counter() - t0) * 1000
+print(json.dumps({'import_ms': ms, 'heavy': [m for m in %r if m in sys.modules]}))
+""" % (HEAVY_MODULES,)
+
+RENDER_PROBE = """
+import json, sys, time
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(%r, default_timeout=60)
+t0 = time.perf_counter()
+at.run()
+first = (time.perf_counter() - t0) * 1000
+t0 = time.perf_counter()
+at.run()
+rerun = (time.perf_counter() - t0) * 1000
+print(json.dumps({'first_render_ms': first, 'rerun_ms': rerun, 'errors': [str(e.value) for e in at.exception],
+                  'heavy': [m for m in %r if m in sys.modules]}))
+"""
+
+def run_probe(code):
+    out = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip())
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Mide el tiempo de importación y de primer render de las apps.")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--max-import-ms', type=float, default=None)
+    parser.add_argument('--max-render-ms', type=float, default=None)
+    parser.add_argument('--max-rerun-ms', type=float, default=None)
+    parser.add_argument('--skip-render', action='store_true', help="Solo mide la importación (no necesita Streamlit).")
+    args = parser.parse_args()
+
+    apps = () if args.skip_render else APPS
+    import_samples = []
+    render_samples = {app: {'first_render_ms': [], 'rerun_ms': []} for app in apps}
+    heavy, errors = set(), []
+    for _ in range(args.repeat):
+        result = run_probe(IMPORT_PROBE)
+        import_samples.append(result['import_ms'])
+        heavy.update(result['heavy'])
+        for app in apps:
+            result = run_probe(RENDER_PROBE % (app, HEAVY_MODULES))
+            render_samples[app]['first_render_ms'].append(result['first_render_ms'])
+            render_samples[app]['rerun_ms'].append(result['rerun_ms'])
+            heavy.update(result['heavy'])
+            errors.extend(f"{app}: {error}" for error in result['errors'])
+
+    report = {'import_ms': round(statistics.median(import_samples), 1)}
+    for app, samples in render_samples.items():
+        report[app] = {name: round(statistics.median(values), 1) for name, values in samples.items()}
+    report['heavy_modules_loaded'] = sorted(heavy)
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    if args.max_import_ms is not None and report['import_ms'] > args.max_import_ms:
+        failures.append(f"import_ms = {report['import_ms']} ms > {args.max_import_ms} ms")
+    limits = {'first_render_ms': args.max_render_ms, 'rerun_ms': args.max_rerun_ms}
+    for app in apps:
+        for name, limit in limits.items():
+            if limit is not None and report[app][name] > limit:
+                failures.append(f"{app} {name} = {report[app][name]} ms > {limit} ms")
+    if heavy:
+        failures.append(f"heavy modules loaded at startup: {', '.join(sorted(heavy))}")
+    if errors:
+        failures.append(f"an app raised on first render: {errors[0]}")
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
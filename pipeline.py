@@ -0,0 +1,498 @@
+# pdfplumber, openpyxl and rapidfuzz are imported inside the functions that use them:
+# the Streamlit page imports this module, and most reruns never process anything.
+import unicodedata
+import re
+import io
+from functools import lru_cache
+
+def load_dependencies():
+    """Imports the heavy modules up front, for long-lived processes that want them warm."""
+    import pdfplumber, openpyxl, openpyxl.styles, openpyxl.utils, rapidfuzz.process
+
+# --- HELPER FUNCTIONS ---
+def normalize_text(text):
+    if not text: return ""
+    nfd = unicodedata.normalize('NFD', str(text))
+    return ''.join(char for char in nfd if unicodedata.category(char) != 'Mn').lower()
+
+def squish_text(text):
+    """Aggressively removes ALL spaces, punctuation, hyphens, and hidden characters for a 100% reliable match."""
+    if not text: return ""
+    t = normalize_text(text)
+    return re.sub(r'[^a-z0-9]', '', t)
+
+def safe_float(val):
+    if val is None: return 0.0
+    s = str(val).strip()
+    if not s or s == '-': return 0.0
+    s = s.replace(',', '')
+    s = re.sub(r'[^\d\.\-]', '', s)
+    if s.count('.') > 1:
+        parts = s.rsplit('.', 1)
+        s = parts[0].replace('.', '') + '.' + parts[1]
+    try: return float(s)
+    except ValueError: return 0.0
+
+def clean_currency(value):
+    if not value: return 0.0
+    raw = str(value).strip().replace(' ', '')
+    raw = re.sub(r'[^\d\.,]', '', raw)
+    if not raw: return 0.0
+
+    if re.search(r',\d{1,2}$', raw):
+        parts = raw.rsplit(',', 1)
+        raw = parts[0].replace('.', '').replace(',', '') + '.' + parts[1]
+    else:
+        raw = raw.replace(',', '')
+
+    if raw.count('.') > 1:
+        parts = raw.rsplit('.', 1)
+        raw = parts[0].replace('.', '') + '.' + parts[1]
+
+    try: return float(raw)
+    except ValueError: return 0.0
+
+def extract_value_from_row(row_list, total_idx):
+    if total_idx != -1 and len(row_list) > total_idx:
+        val = clean_currency(row_list[total_idx])
+        if val > 0: return val
+    for item in reversed(row_list):
+        val = clean_currency(item)
+        if val > 0: return val
+    return 0.0
+
+def get_master_cell(ws, r_idx, c_idx):
+    cell = ws.cell(row=r_idx, column=c_idx)
+    if type(cell).__name__ == 'MergedCell':
+        for m_range in ws.merged_cells.ranges:
+            if cell.coordinate in m_range:
+                return ws.cell(row=m_range.min_row, column=m_range.min_col)
+    return cell
+
+# --- STATIC TABLES ---
+DEPARTMENT_NAME = 'totonicapan'
+
+# MASTER MUNICIPALITY DICTIONARY
+MUNICIPIOS = {
+    1: {"nombre_oficial": "Totonicapán", "alias_pdf": ["totonicapan totonicapan", "totonicapan, totonicapan", "totonicapan"]},
+    2: {"nombre_oficial": "San Cristóbal Totonicapán", "alias_pdf": ["san cristobal totonicapan", "san cristobal"]},
+    3: {"nombre_oficial": "San Francisco El Alto", "alias_pdf": ["san francisco el alto", "san francisco"]},
+    4: {"nombre_oficial": "San Andrés Xecul", "alias_pdf": ["san andres xecul", "san andres"]},
+    5: {"nombre_oficial": "Momostenango", "alias_pdf": ["momostenango"]},
+    6: {"nombre_oficial": "Santa María Chiquimula", "alias_pdf": ["santa maria chiquimula", "sta maria chiquimula", "santa maria", "sta maria"]},
+    7: {"nombre_oficial": "Santa Lucía La Reforma", "alias_pdf": ["santa lucia la reforma", "sta lucia la reforma", "santa lucia", "sta lucia"]},
+    8: {"nombre_oficial": "San Bartolo Aguas Calientes", "alias_pdf": ["san bartolo aguas calientes", "san bartolo"]}
+}
+
+EXCEL_MAPPINGS = {
+    1: "totonicapán", 2: "san cristobal", 3: "san francisco", 4: "san andres",
+    5: "momostenango", 6: "santa maria", 7: "santa lucia", 8: "san bartolo"
+}
+
+CULTIVADOS = ['tomate', 'pina', 'piña', 'banano', 'zanahoria', 'guisquil', 'güisquil', 'cebolla', 'aguacate',
+              'miltomate', 'brocoli', 'brócoli', 'melon', 'melón', 'ejote', 'maiz', 'maíz', 'jamaica',
+              'cebada', 'papaya', 'manzana', 'chile', 'apio', 'ajo', 'cilantro', 'tusa', 'sandia', 'sandía',
+              'platano', 'plátano', 'naranja', 'limon', 'limón', 'lechuga', 'repollo', 'remolacha',
+              'rabano', 'rábano', 'pimiento', 'berenjena', 'calabaza', 'pepino']
+ABARROTES = ['pollo', 'tostada', 'huevo', 'pan', 'queso', 'carne', 'res', 'chowmein', 'chow mein',
+             'chaomein', 'chaumein', 'cahomein', 'crema', 'leche', 'mantequilla', 'aceite', 'arroz',
+             'frijol', 'azucar', 'azúcar', 'sal', 'harina', 'pasta', 'fideos', 'atol', 'incaparina']
+
+# Rows with administrative keywords are never line items
+SKIP_KEYWORDS = ['totales', 'superintendencia', 'datos del certificador',
+                 'contribuyendo', 'sujeto a pagos', 'no genera derecho',
+                 'descripcion', 'cantidad', 'unitario', 'descuentos', 'impuestos']
+
+def build_municipality_matcher(municipios, department_name):
+    """Returns (squished_alias, m_id, nombre_oficial) tuples in the order they must be tried."""
+    search_list = []
+    for m_id, data in municipios.items():
+        for alias in data["alias_pdf"]:
+            search_list.append((squish_text(alias), m_id, data["nombre_oficial"]))
+
+    # CORE FIX: Sorts the list so the department capital (Totonicapán) is ALWAYS evaluated last.
+    # Within the other municipalities, sorts by length to catch specific names first.
+    search_list.sort(key=lambda x: (
+        squish_text(x[2]) == squish_text(department_name),
+        -len(x[0])
+    ))
+    return search_list
+
+# Built once per process at import: every Streamlit session and rerun, every invoice and every
+# API request shares them instead of rebuilding them on each button press
+MUNICIPIO_MATCHER = build_municipality_matcher(MUNICIPIOS, DEPARTMENT_NAME)
+EXCEL_MATCHER = [(m_id, squish_text(key)) for m_id, key in EXCEL_MAPPINGS.items()]
+
+# Exact-word lookup; cultivados is inserted last so it wins on any overlap, like the original check order
+VOCAB_INDEX = {word: 'abarrotes' for word in ABARROTES}
+VOCAB_INDEX.update({word: 'agricultura' for word in CULTIVADOS})
+
+@lru_cache(maxsize=8192)
+def _fuzzy_lookup(word):
+    """Best fuzzy hit of a single word in each vocabulary. Cached because the same words repeat across invoices."""
+    from rapidfuzz import fuzz, process
+    agri = process.extractOne(word, CULTIVADOS, scorer=fuzz.ratio)
+    abar = process.extractOne(word, ABARROTES, scorer=fuzz.ratio)
+    return (agri[0], agri[1]) if agri else (None, 0), (abar[0], abar[1]) if abar else (None, 0)
+
+def fuzzy_match_category(description, threshold=80):
+    """
+    Uses fuzzy matching to categorize a product description.
+    Returns: ('agricultura', best_match_word) or ('abarrotes', best_match_word) or ('unmatched', None)
+    """
+    if not description:
+        return ('unmatched', None)
+
+    # Normalize and extract words from description
+    desc_normalized = normalize_text(description)
+    words = desc_normalized.split()
+
+    # Try exact matches first (original logic)
+    for word in words:
+        category = VOCAB_INDEX.get(word)
+        if category:
+            return (category, word)
+
+    # If no exact match, try fuzzy matching
+    best_agri_match, best_agri_score = None, 0
+    best_abar_match, best_abar_score = None, 0
+
+    for word in words:
+        # Skip very short words (less than 3 chars) for fuzzy matching
+        if len(word) < 3:
+            continue
+
+        (agri_word, agri_score), (abar_word, abar_score) = _fuzzy_lookup(word)
+        if agri_score >= threshold and agri_score > best_agri_score:
+            best_agri_score, best_agri_match = agri_score, agri_word
+        if abar_score >= threshold and abar_score > best_abar_score:
+            best_abar_score, best_abar_match = abar_score, abar_word
+
+    # Return the category with the best match
+    if best_agri_score > best_abar_score and best_agri_match:
+        return ('agricultura', best_agri_match)
+    elif best_abar_match:
+        return ('abarrotes', best_abar_match)
+    else:
+        return ('unmatched', None)
+
+# --- INVOICE EXTRACTION ---
+# The department capital is only a fallback, so it can't be trusted until every page has been read
+FALLBACK_MUNICIPIOS = {m_id for m_id, data in MUNICIPIOS.items()
+                       if squish_text(data["nombre_oficial"]) == squish_text(DEPARTMENT_NAME)}
+
+def find_municipality(text, squished=False):
+    text_squished = text if squished else squish_text(text)
+    # Check against our aggressively squished master list
+    for alias_squished, mun_id, official_name in MUNICIPIO_MATCHER:
+        if alias_squished in text_squished:
+            return mun_id, official_name
+    return None, "N/A"
+
+# Every header field in one pattern. Each alternative sits inside the lookahead so a long match
+# (the emisor name spans several lines) never consumes text where another field starts.
+# The name block is bounded so a "Factura" without a following "Nit Emisor" can't scan the whole document.
+HEADER_PATTERN = re.compile(r"""(?=
+      N[úu]mero\s*de\s*DTE:\s*(?P<dte>\d+)
+    | (?P<uuid>\b[A-F0-9]{8}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{12}\b)
+    | Emisor:\s*(?P<nit_emisor>[0-9Kk\-]+)
+    | Receptor:\s*(?P<nit_receptor>[0-9Kk\-]+)
+    | Factura(?:\s*Pequeño\s*Contribuyente)?\s*\n+(?P<nombre_emisor>(?s:.{0,600}?))\n+Nit\s*Emisor
+)""", re.IGNORECASE | re.VERBOSE)
+HEADER_FIELDS = frozenset(HEADER_PATTERN.groupindex)
+
+def scan_header(text, found):
+    """Fills the header fields missing from `found` with their first occurrence in text. Returns True once all are found."""
+    if len(found) == len(HEADER_FIELDS): return True
+    for m in HEADER_PATTERN.finditer(text):
+        field = m.lastgroup
+        if field not in found:
+            found[field] = m.group(field)
+            if len(found) == len(HEADER_FIELDS): return True
+    return False
+
+def classify_tables(tables):
+    """Sums line items per category. Returns (abar_sum, agri_sum, unmatched) where unmatched is [(description, val)]."""
+    abar_sum, agri_sum = 0, 0
+    unmatched = []
+
+    # Find the Total column and Description column indices
+    total_col_idx = -1
+    desc_col_idx = -1
+
+    for row_tbl in tables:
+        if not row_tbl: continue
+        for idx, cell in enumerate(row_tbl):
+            if not cell: continue
+            cell_norm = normalize_text(str(cell))
+
+            # Find Total column (has "Total" and "(Q)")
+            if 'total' in cell_norm and 'descuento' not in cell_norm and '(q)' in cell_norm:
+                total_col_idx = idx
+
+            # Find Description column
+            if 'descripcion' in cell_norm:
+                desc_col_idx = idx
+
+        if total_col_idx != -1 and desc_col_idx != -1:
+            break
+
+    # If we didn't find the description column, assume it's index 3
+    if desc_col_idx == -1:
+        desc_col_idx = 3
+
+    # Process each row in the tables
+    for row_tbl in tables:
+        if not row_tbl: continue
+
+        # Build full row text for matching
+        row_text = " ".join([str(x) for x in row_tbl if x])
+        row_text_normalized = normalize_text(row_text)
+
+        # FILTER 1: Skip rows with administrative keywords
+        if any(keyword in row_text_normalized for keyword in SKIP_KEYWORDS):
+            continue
+
+        # FILTER 2: First cell should be a number (item number like 1, 2, 3...)
+        if row_tbl and row_tbl[0]:
+            first_cell = str(row_tbl[0]).strip()
+            # Check if first cell is a number (item rows start with 1, 2, 3, etc.)
+            if not first_cell.isdigit():
+                continue
+        else:
+            continue
+
+        # Extract the value
+        val = extract_value_from_row(row_tbl, total_col_idx)
+
+        # Skip rows with zero or invalid value
+        if val <= 0:
+            continue
+
+        # Extract ONLY the description from the correct column
+        description = ""
+        if desc_col_idx < len(row_tbl) and row_tbl[desc_col_idx]:
+            description = str(row_tbl[desc_col_idx]).strip()
+        else:
+            # Fallback: try index 3
+            if len(row_tbl) > 3 and row_tbl[3]:
+                description = str(row_tbl[3]).strip()
+            else:
+                description = row_text
+
+        # Use fuzzy matching to categorize (using full row text for matching)
+        category, matched_word = fuzzy_match_category(row_text, threshold=80)
+
+        if category == 'agricultura':
+            agri_sum += val
+        elif category == 'abarrotes':
+            abar_sum += val
+        elif category == 'unmatched':
+            # Keep ONLY the description for the unmatched items sheet
+            unmatched.append((description, val))
+
+    return abar_sum, agri_sum, unmatched
+
+def read_invoice(pdf_file):
+    """
+    Reads the header fields, the municipality and every table of one invoice.
+    pdf_file may be a path, a file-like object or raw bytes. Returns (header, m_id, m_name, tables).
+    """
+    import pdfplumber
+    if isinstance(pdf_file, (bytes, bytearray)):
+        pdf_file = io.BytesIO(pdf_file)
+
+    header, texts, text_squished = {}, [], ""
+    m_id, m_name = None, "N/A"
+    tables = []
+    with pdfplumber.open(pdf_file) as pdf:
+        for page_idx, p in enumerate(pdf.pages):
+            # Page 1 always; later pages only while a header field or the municipality is still unresolved
+            header_done = len(header) == len(HEADER_FIELDS)
+            municipio_done = m_id is not None and m_id not in FALLBACK_MUNICIPIOS
+            if page_idx == 0 or not (header_done and municipio_done):
+                page_text = p.extract_text() or ""
+                texts.append(page_text)
+                scan_header(page_text, header)
+                text_squished += squish_text(page_text)
+                m_id, m_name = find_municipality(text_squished, squished=True)
+
+            t = p.extract_table()
+            if t: tables.extend(t)
+
+    # A field split across a page break only shows up in the joined text
+    if len(texts) > 1:
+        scan_header("".join(texts), header)
+    return header, m_id, m_name, tables
+
+def clean_emisor_name(header):
+    raw_name = re.sub(r'\s+', ' ', header['nombre_emisor'].strip() if 'nombre_emisor' in header else "N/A")
+    name_e = re.split(r'(?i)n[úu]mero\s*de\s*autorizaci[óo]n', raw_name)[0]
+    return re.split(r'(?i)\bserie\b', name_e)[0].strip()
+
+def process_invoice(pdf_file, file_name):
+    """
+    Extracts and classifies a single invoice. pdf_file may be a path, a file-like object or raw bytes.
+    Returns a plain dict (JSON- and pickle-friendly) with everything needed to update the report.
+    """
+    header, m_id, m_name, tables = read_invoice(pdf_file)
+
+    dte_val = header.get('dte') or file_name
+    uuid_val = header['uuid'].upper() if header.get('uuid') else None
+
+    record = {'archivo': file_name, 'dte': dte_val, 'uuid': uuid_val, 'municipio_id': m_id, 'municipio': m_name}
+    if not m_id:
+        return record
+
+    abar_sum, agri_sum, unmatched = classify_tables(tables)
+
+    nit_e = header['nit_emisor'].strip() if header.get('nit_emisor') else "N/A"
+    nit_r = header['nit_receptor'].strip() if header.get('nit_receptor') else "N/A"
+    name_e = clean_emisor_name(header)
+
+    total_rec = abar_sum + agri_sum
+    perc_abar = (abar_sum / total_rec) if total_rec > 0 else 0
+    alert_status = "⚠️ ALERTA: >30%" if perc_abar > 0.30 else "OK"
+
+    record.update({
+        'nombre_emisor': name_e, 'nit_emisor': nit_e, 'nit_receptor': nit_r,
+        'abarrotes': abar_sum, 'agricultura': agri_sum, 'alerta': alert_status,
+        'sin_clasificar': [{'descripcion': d, 'total': v} for d, v in unmatched],
+    })
+    return record
+
+# --- WORKBOOK ---
+def open_report(xlsx_file):
+    """
+    Loads the user's workbook and maps its columns and municipality rows.
+    Raises ValueError when the base columns can't be found.
+    """
+    import openpyxl
+    if isinstance(xlsx_file, (bytes, bytearray)):
+        xlsx_file = io.BytesIO(xlsx_file)
+    wb = openpyxl.load_workbook(xlsx_file)
+    ws = wb.active
+
+    if "Extra Detalles" not in wb.sheetnames:
+        ws_det = wb.create_sheet("Extra Detalles")
+        ws_det.append(['Nombre Emisor', 'NIT Emisor', 'NIT Receptor', 'Num. DTE', 'Municipio', 'Alerta % Abarrotes'])
+    else:
+        ws_det = wb["Extra Detalles"]
+
+    # Create sheet for unmatched items
+    if "Items Sin Clasificar" not in wb.sheetnames:
+        ws_unmatched = wb.create_sheet("Items Sin Clasificar")
+        ws_unmatched.append(['Descripción', 'Municipio', 'Total (Q)', 'Num. DTE'])
+    else:
+        ws_unmatched = wb["Items Sin Clasificar"]
+
+    # 1. Map Excel Columns dynamically
+    col_map = {}
+    for row in ws.iter_rows(min_row=1, max_row=15):
+        for cell in row:
+            if type(cell).__name__ == 'MergedCell': continue
+            if not cell.value: continue
+            val = normalize_text(str(cell.value))
+
+            if 'abarrotes' in val: col_map['abar'] = cell.column
+            if 'agricultura' in val: col_map['agri'] = cell.column
+            if 'escuela' in val or 'establecimiento' in val: col_map['escuelas'] = cell.column
+            if 'proveedor' in val or 'productor' in val:
+                base_col, base_row, found_total = cell.column, cell.row, False
+                for r_offset in range(1, 4):
+                    for c_offset in range(3):
+                        sub_cell = ws.cell(row=base_row + r_offset, column=base_col + c_offset)
+                        if sub_cell.value and 'total' in normalize_text(str(sub_cell.value)):
+                            col_map['productores'] = sub_cell.column
+                            found_total = True
+                            break
+                    if found_total: break
+                if 'productores' not in col_map: col_map['productores'] = base_col
+
+    if 'abar' not in col_map or 'agri' not in col_map:
+        raise ValueError("No encontré las columnas base en el Excel.")
+
+    # 2. Map Excel Rows to Municipalities
+    row_map = {}
+    for row_ex in ws.iter_rows(min_row=5, max_row=150):
+        row_text = " ".join([str(c.value) for c in row_ex if c.value and type(c).__name__ != 'MergedCell'])
+        row_squished = squish_text(row_text)
+        for m_id, key_squished in EXCEL_MATCHER:
+            if m_id in row_map: continue
+            if key_squished in row_squished:
+                row_map[m_id] = row_ex[0].row
+
+    return {
+        'wb': wb, 'ws': ws, 'ws_det': ws_det, 'ws_unmatched': ws_unmatched,
+        'col_map': col_map, 'row_map': row_map,
+        'batch_totals': {m_id: {'abar': 0.0, 'agri': 0.0, 'emisores': set(), 'receptores': set()} for m_id in MUNICIPIOS.keys()},
+        'new_count': 0,
+    }
+
+def add_invoice(report, record):
+    """Adds one process_invoice() record to the report. Returns False when the municipality wasn't identified."""
+    m_id = record['municipio_id']
+    if not m_id:
+        return False
+
+    for item in record['sin_clasificar']:
+        report['ws_unmatched'].append([item['descripcion'], record['municipio'], item['total'], record['dte']])
+
+    totals = report['batch_totals'][m_id]
+    totals['abar'] += record['abarrotes']
+    totals['agri'] += record['agricultura']
+    if record['nit_emisor'] != "N/A": totals['emisores'].add(record['nit_emisor'])
+    if record['nit_receptor'] != "N/A": totals['receptores'].add(record['nit_receptor'])
+
+    report['ws_det'].append([record['nombre_emisor'], record['nit_emisor'], record['nit_receptor'],
+                             record['dte'], record['municipio'], record['alerta']])
+    report['new_count'] += 1
+    return True
+
+def finish_report(report):
+    """Writes the batch totals into the main sheet, formats the extra sheets and returns the workbook bytes."""
+    from openpyxl.styles import Border, Side
+    from openpyxl.utils import get_column_letter
+    ws, col_map = report['ws'], report['col_map']
+
+    # Write to Main Sheet securely
+    for target_m_id, r_idx in report['row_map'].items():
+        data = report['batch_totals'].get(target_m_id)
+        if not data: continue
+
+        if 'abar' in col_map and data['abar'] > 0:
+            target_cell = get_master_cell(ws, r_idx, col_map['abar'])
+            target_cell.value = safe_float(target_cell.value) + data['abar']
+
+        if 'agri' in col_map and data['agri'] > 0:
+            target_cell = get_master_cell(ws, r_idx, col_map['agri'])
+            target_cell.value = safe_float(target_cell.value) + data['agri']
+
+        if 'escuelas' in col_map and len(data['receptores']) > 0:
+            target_cell = get_master_cell(ws, r_idx, col_map['escuelas'])
+            target_cell.value = int(safe_float(target_cell.value)) + len(data['receptores'])
+
+        if 'productores' in col_map and len(data['emisores']) > 0:
+            target_cell = get_master_cell(ws, r_idx, col_map['productores'])
+            target_cell.value = int(safe_float(target_cell.value)) + len(data['emisores'])
+
+    # Format "Extra Detalles" and "Items Sin Clasificar"
+    thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+    for sheet in (report['ws_det'], report['ws_unmatched']):
+        for col in sheet.columns:
+            max_length = 0
+            col_letter = get_column_letter(col[0].column)
+            for cell in col:
+                cell.border = thin_border
+                try: max_length = max(max_length, len(str(cell.value)))
+                except: pass
+            sheet.column_dimensions[col_letter].width = max_length + 2
+
+    output = io.BytesIO()
+    report['wb'].save(output)
+    return output.getvalue()
+
+def unmatched_count(report):
+    # Count unmatched items (excluding header row)
+    ws_unmatched = report['ws_unmatched']
+    return ws_unmatched.max_row - 1 if ws_unmatched.max_row > 1 else 0
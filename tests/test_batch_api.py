@@ -0,0 +1,193 @@
+import http.client
+import io
+import json
+import socket
+import time
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+
+import openpyxl
+import pytest
+
+import batch_api
+from conftest import make_pdf
+
+MOMOS = make_pdf(["Factura\nPRODUCTOS DEL CAMPO\nNit Emisor: 1234567-K\nNit Receptor: 998877-1\n"
+                  "Numero de DTE: 4455\nMomostenango, Totonicapan"])
+SIN_MUNICIPIO = make_pdf(["Factura\nNADA\nNit Emisor: 1-1"])
+
+def _zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+def _multipart(files, boundary='frontera'):
+    body = b""
+    for name, data in files:
+        body += (f'--{boundary}\r\nContent-Disposition: form-data; name="f"; filename="{name}"\r\n'
+                 f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + b'\r\n'
+    return body + f'--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+def _workbook():
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws['A1'], ws['B1'], ws['C1'] = 'Municipio', 'Abarrotes', 'Agricultura'
+    ws['A5'], ws['A6'] = 'Totonicapán', 'Momostenango'
+    buf = io.BytesIO()
+    wb.save(buf)
+    return buf.getvalue()
+
+def _request(server, method, path, body=None, headers=None):
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=60)
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return response, data
+
+def _post(server, body, content_type, headers=None):
+    response, data = _request(server, 'POST', '/procesar', body, {'Content-Type': content_type, **(headers or {})})
+    lines = [json.loads(line) for line in data.decode('utf-8').splitlines()] if response.status == 200 else json.loads(data)
+    return response, lines
+
+# --- parse_upload ---
+def test_parse_upload_bare_pdf():
+    pdfs, xlsx = batch_api.parse_upload('application/pdf', MOMOS, 'a.pdf')
+    assert pdfs == [('a.pdf', MOMOS)] and xlsx is None
+
+def test_parse_upload_zip_skips_hidden_and_folders():
+    body = _zip({'lote/a.pdf': MOMOS, '__MACOSX/.a.pdf': b'x', 'b.pdf': SIN_MUNICIPIO})
+    pdfs, _ = batch_api.parse_upload('application/zip', body)
+    assert [name for name, _ in pdfs] == ['a.pdf', 'b.pdf']
+
+def test_parse_upload_multipart_mix():
+    xlsx = _workbook()
+    body, ctype = _multipart([('a.pdf', MOMOS), ('mas.zip', _zip({'b.pdf': SIN_MUNICIPIO})), ('r.xlsx', xlsx)])
+    pdfs, excel = batch_api.parse_upload(ctype, body)
+    assert pdfs == [('a.pdf', MOMOS), ('b.pdf', SIN_MUNICIPIO)]
+    assert excel == xlsx
+
+def test_parse_upload_rejects_bad_input():
+    with pytest.raises(ValueError):
+        batch_api.parse_upload('text/plain', b'hola')
+    with pytest.raises(ValueError):
+        batch_api.parse_upload('application/zip', _zip({'notas.txt': b'x'}))
+    with pytest.raises(ValueError):
+        batch_api.parse_upload('application/zip', b'PK\x03\x04 roto')
+
+def test_parse_upload_limits_zip_depth():
+    nested = _zip({'c.zip': _zip({'d.zip': _zip({'a.pdf': MOMOS})})})
+    with pytest.raises(ValueError, match="anidados"):
+        batch_api.parse_upload('application/zip', nested)
+
+def test_parse_upload_limits_unzipped_size(monkeypatch):
+    monkeypatch.setattr(batch_api, 'MAX_UNZIPPED_BYTES', 1000)
+    with pytest.raises(ValueError, match="demasiado grande"):
+        batch_api.parse_upload('application/zip', _zip({'a.pdf': MOMOS + b'\0' * 2000}))
+
+# --- HTTP ---
+def test_stream_lines_then_fin(batch_server):
+    response, lines = _post(batch_server, _zip({'a.pdf': MOMOS, 'b.pdf': SIN_MUNICIPIO}), 'application/zip')
+    assert response.status == 200
+    assert response.getheader('Content-Type').startswith('application/x-ndjson')
+    assert [line['tipo'] for line in lines] == ['factura', 'factura', 'fin']
+    by_name = {line['archivo']: line for line in lines[:2]}
+    assert by_name['a.pdf']['municipio'] == 'Momostenango'
+    assert by_name['a.pdf']['dte'] == '4455'
+    assert by_name['b.pdf']['municipio_id'] is None
+    assert lines[-1]['lote'] == response.getheader('X-Lote')
+    assert lines[-1]['procesadas'] == 1 and lines[-1]['sin_municipio'] == 1
+
+def test_excel_endpoint_with_workbook(batch_server):
+    body, ctype = _multipart([('a.pdf', MOMOS), ('r.xlsx', _workbook())])
+    response, lines = _post(batch_server, body, ctype)
+    run_id = lines[-1]['lote']
+
+    excel_response, data = _request(batch_server, 'GET', f'/lotes/{run_id}/excel')
+    assert excel_response.status == 200
+    wb = openpyxl.load_workbook(io.BytesIO(data))
+    detalles = list(wb['Extra Detalles'].values)
+    assert detalles[1][1:5] == ('1234567-K', '998877-1', '4455', 'Momostenango')
+
+    metrics_response, data = _request(batch_server, 'GET', f'/lotes/{run_id}/metricas')
+    assert metrics_response.status == 200 and json.loads(data)['facturas'] == 1
+
+def test_excel_endpoint_without_workbook(batch_server):
+    _, lines = _post(batch_server, MOMOS, 'application/pdf')
+    response, _ = _request(batch_server, 'GET', f"/lotes/{lines[-1]['lote']}/excel")
+    assert response.status == 404
+
+def test_excel_error_is_reported(batch_server, monkeypatch):
+    def broken(report):
+        raise RuntimeError("disco lleno")
+    monkeypatch.setattr(batch_api.pipeline, 'finish_report', broken)
+    body, ctype = _multipart([('a.pdf', MOMOS), ('r.xlsx', _workbook())])
+    _, lines = _post(batch_server, body, ctype)
+    assert [line['tipo'] for line in lines] == ['factura', 'error', 'fin']
+
+    response, data = _request(batch_server, 'GET', f"/lotes/{lines[-1]['lote']}/excel")
+    assert response.status == 500 and 'disco lleno' in json.loads(data)['error']
+
+def test_not_found(batch_server):
+    assert _request(batch_server, 'GET', '/lotes/nada/metricas')[0].status == 404
+    assert _request(batch_server, 'GET', '/otra')[0].status == 404
+    assert _request(batch_server, 'POST', '/otra', b'x')[0].status == 404
+
+def test_bad_request(batch_server):
+    assert _post(batch_server, b'hola', 'text/plain')[0].status == 400
+    # A zip named .xlsx that isn't a workbook
+    body, ctype = _multipart([('a.pdf', MOMOS), ('r.xlsx', _zip({'hoja.txt': b'x'}))])
+    response, payload = _post(batch_server, body, ctype)
+    assert response.status == 400 and 'Excel' in payload['error']
+
+def test_missing_length(batch_server):
+    assert _request(batch_server, 'POST', '/procesar', None, {'Content-Type': 'application/pdf'})[0].status == 411
+
+    conn = socket.create_connection(('127.0.0.1', batch_server.server_address[1]), timeout=10)
+    conn.sendall(b"POST /procesar HTTP/1.1\r\nHost: x\r\nContent-Type: application/pdf\r\nContent-Length: abc\r\n\r\n")
+    reply = conn.recv(4096)
+    conn.close()
+    assert reply.startswith(b"HTTP/1.0 400")
+
+def test_body_too_large(batch_server, monkeypatch):
+    monkeypatch.setattr(batch_api, 'MAX_BODY_BYTES', 10)
+    assert _post(batch_server, MOMOS, 'application/pdf')[0].status == 413
+
+def test_recovers_from_dead_worker(batch_server):
+    for process in list(batch_server.executor._processes.values()):
+        process.kill()
+    time.sleep(0.5)
+    response, lines = _post(batch_server, MOMOS, 'application/pdf')
+    assert response.status == 200
+    assert lines[0]['municipio'] == 'Momostenango'
+
+def test_submit_uses_replacement_pool(batch_server):
+    healthy = batch_server.executor
+
+    class ShutDownByAnotherRequest:
+        def submit(self, *args):
+            # Mimics reset_pool swapping the pool between reading self.executor and submit()
+            batch_server.executor = healthy
+            raise RuntimeError('cannot schedule new futures after shutdown')
+
+    batch_server.executor = ShutDownByAnotherRequest()
+    executor, futures = batch_server.submit_batch([('a.pdf', MOMOS)])
+    assert executor is healthy
+    assert next(iter(futures)).result()[1]['municipio'] == 'Momostenango'
+
+def test_failed_start_releases_socket(monkeypatch):
+    def broken_pool(self):
+        raise BrokenProcessPool("sin workers")
+    monkeypatch.setattr(batch_api.BatchServer, '_start_pool', broken_pool)
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    with pytest.raises(BrokenProcessPool):
+        batch_api.BatchServer(('127.0.0.1', port), workers=1)
+    # Binding again only works if the failed server closed its socket
+    again = socket.socket()
+    again.bind(('127.0.0.1', port))
+    again.close()
@@ -0,0 +1,90 @@
+import io
+import re
+
+import pdfplumber.page
+
+import pipeline
+from conftest import make_pdf
+
+HEADER = ("Factura Pequeño Contribuyente\nDISTRIBUIDORA EL SOL\nNúmero de Autorización:\n"
+          "1A2B3C4D-1111-2222-3333-ABCDEF012345\nSerie: 1A2B Número de DTE: 998877\n"
+          "Nit Emisor: 1234567-K\nNit Receptor: 99887-1 Fecha")
+
+def old_header(text):
+    """The five searches the scanner replaced, run over the joined text."""
+    found = {}
+    for field, pattern, flags in [
+        ('dte', r'N[úu]mero\s*de\s*DTE:\s*(\d+)', re.I),
+        ('uuid', r'\b([A-F0-9]{8}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{4}-[A-F0-9]{12})\b', re.I),
+        ('nit_emisor', r'Emisor:\s*([0-9Kk\-]+)', re.I),
+        ('nit_receptor', r'Receptor:\s*([0-9Kk\-]+)', re.I),
+        ('nombre_emisor', r'(?:Factura(?:\s*Pequeño\s*Contribuyente)?)\s*\n+(.*?)\n+Nit\s*Emisor', re.I | re.S),
+    ]:
+        m = re.search(pattern, text, flags)
+        if m: found[field] = m.group(1)
+    return found
+
+def joined_text(pdf_bytes):
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return "".join(p.extract_text() or "" for p in pdf.pages)
+
+def test_single_page_header_matches_old_regexes():
+    text = HEADER + "\nMomostenango, Totonicapán"
+    found = {}
+    assert pipeline.scan_header(text, found)
+    assert found == old_header(text)
+
+def test_emisor_without_space_still_matches():
+    text = "NitEmisor:55\nNitReceptor:66"
+    found = {}
+    pipeline.scan_header(text, found)
+    assert found == old_header(text) == {'nit_emisor': '55', 'nit_receptor': '66'}
+
+def test_factura_without_nit_emisor():
+    text = "Factura\nNOMBRE\n" + "relleno\n" * 500 + "Numero de DTE: 1"
+    found = {}
+    assert not pipeline.scan_header(text, found)
+    assert found == old_header(text) == {'dte': '1'}
+
+def test_field_only_on_page_two():
+    pdf = make_pdf([HEADER.replace("Nit Receptor: 99887-1 Fecha", "") + "\nMomostenango",
+                    "Nit Receptor: 99887-1"])
+    header, m_id, m_name, _ = pipeline.read_invoice(pdf)
+    assert header == old_header(joined_text(pdf))
+    assert header['nit_receptor'] == '99887-1'
+    assert m_name == "Momostenango"
+
+def test_field_split_across_page_break():
+    first, rest = HEADER.split(" 998877")
+    pdf = make_pdf(["Momostenango\n" + first, "998877" + rest])
+    header, _, _, _ = pipeline.read_invoice(pdf)
+    # Neither page has the DTE on its own; only the joined-text pass can find it
+    assert 'dte' not in old_header(first) and 'dte' not in old_header("998877" + rest)
+    assert header == old_header(joined_text(pdf))
+    assert header['dte'] == '998877'
+
+def test_capital_on_page_one_keeps_reading(monkeypatch):
+    pdf = make_pdf([HEADER + "\nTotonicapán", "Entrega en Momostenango"])
+    calls = _count_extract_text(monkeypatch)
+    _, m_id, m_name, _ = pipeline.read_invoice(pdf)
+    assert calls['n'] == 2
+    assert pipeline.find_municipality(joined_text(pdf)) == (m_id, m_name) == (5, "Momostenango")
+
+def test_stops_extracting_text_once_resolved(monkeypatch):
+    pdf = make_pdf([HEADER + "\nMomostenango", "Nit Receptor: 1-1", "San Francisco El Alto"])
+    calls = _count_extract_text(monkeypatch)
+    record = pipeline.process_invoice(pdf, "a.pdf")
+    assert calls['n'] == 1
+    assert record['municipio'] == "Momostenango"
+    assert record['nit_receptor'] == '99887-1'
+    assert record['nombre_emisor'] == "DISTRIBUIDORA EL SOL"
+    assert record['uuid'] == "1A2B3C4D-1111-2222-3333-ABCDEF012345"
+
+def _count_extract_text(monkeypatch):
+    calls = {'n': 0}
+    original = pdfplumber.page.Page.extract_text
+    def counting(self, *args, **kwargs):
+        calls['n'] += 1
+        return original(self, *args, **kwargs)
+    monkeypatch.setattr(pdfplumber.page.Page, 'extract_text', counting)
+    return calls